@@ -5,15 +5,30 @@ from pathlib import Path
 import pandas as pd
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 import base64
+import copy
+import operator
 try:
     from groq import Groq
 except Exception:
     Groq = None
+try:
+    import orjson
+except Exception:
+    orjson = None
+try:
+    import pyarrow.parquet as pq
+except Exception:
+    pq = None
 from dotenv import load_dotenv, find_dotenv
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import time
 import re
+import threading
 from collections import defaultdict
+from dataclasses import dataclass
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 
 # Import the NC converter and export utilities
@@ -22,7 +37,7 @@ from export_utils import (export_ascii, export_csv, export_json,
                           export_netcdf, export_session, get_summary_report)
 
 # Enhanced .env loading with multiple fallback locations
-def load_environment():
+def _load_dotenv_file():
     """Load .env from multiple possible locations"""
     # Try 1: Automatic find
     env_path = find_dotenv()
@@ -54,17 +69,29 @@ def load_environment():
     print("❌ No .env file found in any location")
     return False
 
+
+# Streamlit re-executes this script on every interaction; caching as a
+# resource makes the .env search and key report run once per process
+@st.cache_resource(show_spinner=False)
+def load_environment():
+    """Load environment variables and print which API keys were found"""
+    loaded = _load_dotenv_file()
+    
+    # Debug: Print what was loaded (first 10 chars only for security)
+    mistral_key = os.getenv("MISTRAL_API_KEY", "")
+    groq_key = os.getenv("GROQ_API_KEY", "")
+    print(f"\n🔑 Environment Check:")
+    print(f"   MISTRAL_API_KEY: {'✅ Found (' + mistral_key[:10] + '...)' if mistral_key else '❌ Not found'}")
+    print(f"   GROQ_API_KEY: {'✅ Found (' + groq_key[:10] + '...)' if groq_key else '❌ Not found'}")
+    print(f"   Current working directory: {os.getcwd()}")
+    print(f"   Script location: {Path(__file__).parent}\n")
+    return loaded
+
+
 # Load environment variables
 load_environment()
 
-# Debug: Print what was loaded (first 10 chars only for security)
-mistral_key = os.getenv("MISTRAL_API_KEY", "")
-groq_key = os.getenv("GROQ_API_KEY", "")
-print(f"\n🔑 Environment Check:")
-print(f"   MISTRAL_API_KEY: {'✅ Found (' + mistral_key[:10] + '...)' if mistral_key else '❌ Not found'}")
-print(f"   GROQ_API_KEY: {'✅ Found (' + groq_key[:10] + '...)' if groq_key else '❌ Not found'}")
-print(f"   Current working directory: {os.getcwd()}")
-print(f"   Script location: {Path(__file__).parent}\n")
+DEBUG = os.getenv("DEBUG", "").lower() in ("1", "true", "yes")
 
 
 st.set_page_config(
@@ -74,491 +101,435 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# CSS - Full styling preserved
-def inject_custom_css():
-    st.markdown("""
-    <style>
-    @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600;700&display=swap');
-    * { font-family: 'Inter', sans-serif; }
-    .stApp { background: #0a0a0a; }
-    .main { padding: 0 !important; }
-    .block-container { padding: 1rem 1.5rem !important; max-width: 100% !important; }
-    
-    h1 { color: #00b4d8; font-size: 1.6rem; margin-bottom: 0.3rem; }
-    h3 { color: #90e0ef; font-size: 1rem; margin: 0.5rem 0; }
-    
-    /* SIDEBAR - Purple Dark Theme */
-    section[data-testid="stSidebar"] {
-        background: linear-gradient(180deg, #1a1625 0%, #0f0a1e 100%);
-        border-right: 2px solid #2d1b69;
-    }
-    
-    section[data-testid="stSidebar"] > div {
-        background: transparent;
-        padding: 1.5rem 1rem;
-    }
-    
-    /* Sidebar Headers */
-    section[data-testid="stSidebar"] h3 {
-        color: #9d84c7 !important;
-        font-size: 0.9rem;
-        margin: 1rem 0 0.6rem 0;
-        font-weight: 600;
-        letter-spacing: 0.5px;
-    }
-    
-    /* Sidebar Buttons - Equal Size & Purple Theme */
-    section[data-testid="stSidebar"] .stButton button {
-        background: linear-gradient(145deg, #2d1b69, #1a0f3d) !important;
-        color: #b8a3d9 !important;
-        border: 1px solid #3d2472 !important;
-        border-radius: 8px !important;
-        padding: 0.65rem 1rem !important;
-        font-size: 0.85rem !important;
-        font-weight: 500 !important;
-        width: 100% !important;
-        height: 42px !important;
-        min-width: 100% !important;
-        box-shadow: 0 2px 8px rgba(45, 27, 105, 0.4) !important;
-        transition: all 0.3s ease !important;
-        display: flex !important;
-        align-items: center !important;
-        justify-content: center !important;
-        text-align: center !important;
-    }
-    
-    section[data-testid="stSidebar"] .stButton button:hover {
-        background: linear-gradient(145deg, #4a2f8c, #2d1b69) !important;
-        border-color: #6a4ba8 !important;
-        color: #e0d4f7 !important;
-        transform: translateY(-2px) !important;
-        box-shadow: 0 4px 12px rgba(106, 75, 168, 0.5) !important;
-    }
-    
-    section[data-testid="stSidebar"] .stButton button:active {
-        transform: translateY(0) !important;
-    }
-    
-    /* Sidebar Stats Text */
-    section[data-testid="stSidebar"] [data-testid="stMarkdownContainer"] {
-        color: #9d84c7 !important;
-    }
-    
-    /* Sidebar Dividers */
-    section[data-testid="stSidebar"] hr {
-        border-color: #2d1b69;
-        margin: 1rem 0;
-        opacity: 0.5;
-    }
-    
-    /* Sidebar Text Colors */
-    section[data-testid="stSidebar"] p,
-    section[data-testid="stSidebar"] span,
-    section[data-testid="stSidebar"] div {
-        color: #b8a3d9 !important;
-    }
-    
-    section[data-testid="stSidebar"] .stCaption {
-        color: #6a4ba8 !important;
-        font-size: 0.75rem !important;
-    }
-    
-    /* Header */
-    .main-header {
-        background: #0a0a0a;
-        padding: 1rem 2rem;
-        border-bottom: 1px solid #00b4d8;
-        position: sticky;
-        top: 0;
-        z-index: 100;
-        text-align: center;
-    }
-    
-    .main-header h1 {
-        color: #00b4d8;
-        font-size: 1.5rem;
-        font-weight: 600;
-        margin: 0;
-    }
-    
-    .main-header p {
-        color: #90e0ef;
-        font-size: 0.9rem;
-        margin: 0.25rem 0 0 0;
-    }
-    
-    /* Chat messages */
-    .chat-container {
-        max-width: 900px;
-        margin: 0 auto;
-        padding: 1.5rem 1rem;
-    }
-    
-    .chat-message {
-        padding: 0.8rem 1.1rem;
-        margin-bottom: 1rem;
-        border-radius: 16px;
-        animation: fadeIn 0.3s ease-out;
-        width: fit-content;
-        max-width: 70%;
-    }
-    
-    @keyframes fadeIn {
-        from { opacity: 0; transform: translateY(10px); }
-        to { opacity: 1; transform: translateY(0); }
-    }
-    
-    .user-message {
-        background: linear-gradient(135deg, #0077b6 0%, #00b4d8 100%);
-        border: 1px solid #0096c7;
-        color: #ffffff;
-        margin-left: auto;
-        margin-right: 0;
-        max-width: 65%;
-        box-shadow: 0 4px 12px rgba(0,119,182,0.3);
-    }
-    
-    .assistant-message {
-        background: #16213e;
-        border: 1px solid #0f3460;
-        color: #caf0f8;
-        margin-right: auto;
-        margin-left: 0;
-        max-width: 85%;
-        box-shadow: 0 4px 12px rgba(15,52,96,0.4);
-    }
-    
-    .message-avatar {
-        font-size: 0.7rem;
-        margin-bottom: 0.3rem;
-        font-weight: 600;
-        opacity: 0.9;
-    }
-    
-    .user-message .message-avatar {
-        color: #e6f4ff;
-    }
-    
-    .assistant-message .message-avatar {
-        color: #00b4d8;
-    }
-    
-    .message-content {
-        line-height: 1.7;
-        font-size: 0.9rem;
-    }
-    
-    /* Chat input */
-    .stChatInput { 
-        border: 2px solid #0077b6 !important; 
-        border-radius: 12px !important; 
-        background: #16213e !important;
-    }
-    
-    .stChatInput input {
-        color: #caf0f8 !important;
-        font-size: 0.95rem !important;
-        background: #16213e !important;
-    }
-    
-    .stChatInput input::placeholder {
-        color: #4a7c9c !important;
-    }
-    
-    .stChatInput button {
-        background: linear-gradient(135deg, #0077b6 0%, #00b4d8 100%) !important;
-        color: white !important;
-        border: none !important;
-        border-radius: 8px !important;
-        padding: 0.5rem 1rem !important;
-        font-size: 0.9rem !important;
-        font-weight: 600 !important;
-    }
-    
-    .stChatInput button:hover {
-        background: linear-gradient(135deg, #00b4d8 0%, #90e0ef 100%) !important;
-    }
-    
-    /* File uploader */
-    .stFileUploader {
-        background: #1a0f3d;
-        border: 2px dashed #3d2472;
-        border-radius: 10px;
-        padding: 1rem;
-    }
-    
-    /* Expander */
-    .streamlit-expanderHeader {
-        background: #16213e;
-        border: 1px solid #0077b6;
-        border-radius: 8px;
-        color: #90e0ef;
-        padding: 0.6rem 0.9rem;
-        font-size: 0.85rem;
-    }
-    
-    .streamlit-expanderHeader:hover {
-        background: #1a2a4e;
-        border-color: #00b4d8;
-    }
-    
-    .streamlit-expanderContent {
-        background: #0f1f3e;
-        border: 1px solid #0f3460;
-        border-top: none;
-        color: #caf0f8;
-        padding: 0.9rem;
-    }
-    
-    /* Messages */
-    .stSuccess {
-        background: rgba(0,180,216,0.15);
-        border: 1px solid rgba(0,180,216,0.4);
-        color: #00b4d8;
-        border-radius: 8px;
-    }
-    
-    .stError {
-        background: rgba(239,68,68,0.15);
-        border: 1px solid rgba(239,68,68,0.4);
-        color: #ef4444;
-        border-radius: 8px;
-    }
-    
-    .stInfo {
-        background: rgba(144,224,239,0.15);
-        border: 1px solid rgba(144,224,239,0.4);
-        color: #90e0ef;
-        border-radius: 8px;
-    }
-    
-    /* Spinner */
-    .stSpinner > div {
-        border-color: #00b4d8 transparent transparent transparent !important;
-    }
-    
-    /* Scrollbar */
-    ::-webkit-scrollbar {
-        width: 8px;
-    }
-    
-    ::-webkit-scrollbar-track {
-        background: #0a0a0a;
-    }
-    
-    ::-webkit-scrollbar-thumb {
-        background: #0077b6;
-        border-radius: 4px;
-    }
-    
-    ::-webkit-scrollbar-thumb:hover {
-        background: #00b4d8;
-    }
-    
-    hr {
-        border-color: #0f3460;
-        margin: 1rem 0;
-    }
-    
-    /* Hide default elements */
-    #MainMenu {visibility: hidden;}
-    footer {visibility: hidden;}
-    header {visibility: hidden;}
-    </style>
-    """, unsafe_allow_html=True)
+# CSS - Full styling preserved in assets/style.css
+CSS_PATH = Path(__file__).parent / "assets" / "style.css"
 
 
-# Enhanced Production System Prompt
-SYSTEM_PROMPT = """You are FloatChat AI, an advanced oceanographic intelligence assistant specializing in ARGO float data analysis for the Indian Ocean region. You combine real-time dataset analysis with comprehensive oceanographic knowledge to provide accurate, scientifically rigorous insights.
+@st.cache_data(show_spinner=False)
+def _load_css(css_path=CSS_PATH):
+    """Minified <style> block, read from disk once instead of on every rerun"""
+    css = re.sub(r'/\*.*?\*/', '', Path(css_path).read_text(encoding='utf-8'), flags=re.S)
+    lines = (line.strip() for line in css.splitlines())
+    return "<style>" + "\n".join(line for line in lines if line) + "</style>"
 
-CORE CAPABILITIES:
-==================
-1. **Primary Data Source**: ARGO float measurements from Indian Ocean (Bay of Bengal, Arabian Sea, Southern Ocean, Equatorial Indian Ocean)
-2. **Backup Intelligence**: When local data is unavailable, seamlessly integrate global oceanographic databases, peer-reviewed research, and validated scientific sources
-3. **Smart Query Routing**: Intelligently distinguish between ocean-related queries and off-topic requests
 
-RESPONSE PROTOCOL:
-==================
+def inject_custom_css():
+    st.markdown(_load_css(), unsafe_allow_html=True)
 
-SCENARIO 1: COMPLETE LOCAL DATA AVAILABLE
-------------------------------------------
-When context contains relevant ARGO data:
 
-**Query Summary**
-[Restate user's question concisely]
+# Core system prompt, kept byte-identical across calls so providers can cache the prefix
+CORE_PROMPT = """You are FloatChat AI, an oceanographic assistant for ARGO float data in the Indian Ocean (Bay of Bengal, Arabian Sea, Equatorial Indian Ocean, Southern Ocean). Answer from the CONTEXT DATA first; when it is thin, add well-established oceanographic knowledge.
 
-**Profile Overview**
-• Date: [Actual datetime from dataset]
-• Location: [Precise coordinates with region name]
-• Platform: [Float ID if available]
-• Data Quality: [Processing level - Real-time/Delayed mode]
+SCOPE: Indian Ocean, Bay of Bengal, Arabian Sea, Southern Ocean, Red Sea, Persian Gulf, Andaman Sea. For Atlantic/Pacific queries reply: "This system focuses exclusively on Indian Ocean regions. For [region], I recommend consulting regional oceanographic databases." Redirect non-marine topics.
 
-**Measurements**
-• Temperature: Min [X]°C, Max [Y]°C, Mean [Z]°C (Depth range: [A-B]m)
-• Salinity: Min [X] PSU, Max [Y] PSU, Mean [Z] PSU
-• Pressure/Depth: Surface to [Max]m ([N] measurement points)
-• [BGC Parameters if available]: Oxygen, Chlorophyll, Nitrate, pH
+SOURCES: Never say "public data" or "web sources". Phrase outside knowledge scientifically: "Based on climatological records...", "Oceanographic studies indicate...", "Published research from INCOIS/NOAA reports...".
 
-**Scientific Analysis**
-• [Oceanographic interpretation with real values]
-• [Water mass identification if detected]
-• [Anomalies or notable features]
-• [Seasonal/regional context]
+RULES:
+1. Never fabricate data; label values not in the dataset as "typical range" or "climatological average".
+2. No placeholder values (X.XX) - use real data or established ranges.
+3. Prioritise uploaded/stored ARGO data and blend in external knowledge without mentioning source switching.
+4. Every statement must be defensible from oceanographic literature.
+5. Expert, professional tone; acknowledge data gaps honestly.
 
-**Key Findings**
-1. [Major insight with specific data]
-2. [Trend or pattern observed]
-3. [Scientific significance]
+STYLE: Concise and quantitative; tables, bullets and section headers; proper oceanographic terminology; interpret, don't just list numbers.
+"""
 
----
+RESPONSE_HEADER = """
+RESPONSE FORMAT (use the one that fits the context):
 
-SCENARIO 2: PARTIAL DATA - AUGMENTED WITH SCIENTIFIC KNOWLEDGE
----------------------------------------------------------------
-When context has limited data:
+"""
 
-**Query Summary**
-[User's question]
+# Only the template matching the query type is sent; see classify_query()
+SCENARIO_TEMPLATES = {
+    'local_data': """[1] Full local data: **Query Summary** | **Profile Overview** (date, coordinates + region, float ID, real-time/delayed mode) | **Measurements** (TEMP and PSAL min/max/mean, depth range and point count, BGC if present) | **Scientific Analysis** (water masses, anomalies, seasonal context) | **Key Findings** (3 numbered, data-backed).
 
-**Available Local Data**
-• [List what exists in context with specific values]
+[2] Partial data: **Query Summary** | **Available Local Data** (values from context) | **Scientific Context** (climatology, typical regional/seasonal ranges) | **Integrated Analysis** | **Recommendation** ("For more detailed analysis of [aspect], data from [period/location] would provide additional insights.").
+""",
+    'comparison': """[3] Comparison: **Comparative Analysis** | **Data Summary** table (Metric, Period 1, Period 2, Change, % Difference) | **Statistical Significance** | **Scientific Interpretation** (drivers of change).
+""",
+    'off_topic': """[4] Off-topic: say FloatChat AI specialises in Indian Ocean ARGO data analysis and that [topic] is outside its domain; offer temperature/salinity profiles, water masses, BGC parameters (oxygen, chlorophyll, nutrients), seasonal variability and period/region comparisons, with 2-3 example queries.
+""",
+}
 
-**Scientific Context** *(from oceanographic databases)*
-• [Relevant climatological information]
-• [Typical ranges for the region/season]
-• [Historical patterns from literature]
+# Full prompt with every format, for callers that don't classify the query
+SYSTEM_PROMPT = CORE_PROMPT + RESPONSE_HEADER + "\n".join(SCENARIO_TEMPLATES.values())
+SCENARIO_PROMPTS = {scenario: CORE_PROMPT + RESPONSE_HEADER + template
+                    for scenario, template in SCENARIO_TEMPLATES.items()}
 
-**Integrated Analysis**
-[Combine local measurements with scientific knowledge]
 
-**Recommendation**
-"For more detailed analysis of [specific aspect], data from [suggested time period/location] would provide additional insights."
+# orjson parses the float-heavy profile files several times faster than json
+_json_loads = orjson.loads if orjson else json.loads
 
----
 
-SCENARIO 3: NO RELEVANT LOCAL DATA
------------------------------------
-When context lacks requested information:
+# Profiles sent to the LLM per query; each one costs a digest's worth of input tokens
+CONTEXT_TOP_K = 5
+DIGEST_VARIABLES = ('TEMP', 'PSAL', 'DOXY')
+# Statistics outside this open range are ARGO fill values (99999, -999), not data
+FILL_VALUE_LIMITS = (-990, 9999)
 
-**Query Summary**
-[User's question]
 
-**Data Availability Status**
-❌ No matching profiles found for: [Specific date/region/parameter]
+def _valid_stat(value):
+    """Rounded statistic, or None when it is missing or a fill value"""
+    if value is None or not FILL_VALUE_LIMITS[0] < value < FILL_VALUE_LIMITS[1]:
+        return None
+    return round(float(value), 2)
 
-**Available Alternatives in Dataset:**
-• [Nearby date 1]: [Region] - [Parameters available]
-• [Nearby date 2]: [Region] - [Parameters available]
 
-**General Oceanographic Information** *(scientific literature)*
-[Provide well-established facts about the queried topic]
+def summarize_profile(profile):
+    """Compact digest of one profile for the LLM: header plus [min, max, mean] per variable"""
+    temporal = profile.get('temporal', {})
+    spatial = profile.get('geospatial', {})
+    core_vars = profile.get('measurements', {}).get('core_variables', {})
+    
+    summary = {
+        'date': profile.get('_date10') or (temporal.get('datetime') or 'unknown')[:10],
+        'region': ', '.join(spatial.get('regional_seas', [])) or 'Ocean'
+    }
+    if spatial.get('latitude') is not None and spatial.get('longitude') is not None:
+        summary['lat'] = round(float(spatial['latitude']), 2)
+        summary['lon'] = round(float(spatial['longitude']), 2)
+    if profile.get('_uploaded_filename'):
+        summary['file'] = profile['_uploaded_filename']
+    
+    for var in DIGEST_VARIABLES:
+        var_data = core_vars.get(var, {})
+        if var_data.get('present'):
+            stats = var_data.get('statistics', {})
+            summary[var] = [_valid_stat(stats.get(stat)) for stat in ('min', 'max', 'mean')]
+    
+    pres_data = core_vars.get('PRES', {})
+    depth_max = _valid_stat(pres_data.get('statistics', {}).get('max')) if pres_data.get('present') else None
+    if depth_max is not None:
+        summary['depth_max'] = round(depth_max)
+    
+    return summary
 
-**Suggested Query**
-"Try: 'Show me [alternative query that would work with available data]'"
 
----
+def prepare_profile(profile):
+    """Attach the display date and LLM digest (dict and pre-serialized) so queries only join strings
+    
+    These keys are listed in export_utils.DERIVED_PROFILE_KEYS and left out of JSON exports.
+    """
+    profile['_date10'] = (profile.get('temporal', {}).get('datetime') or 'unknown')[:10]
+    profile['_summary'] = summarize_profile(profile)
+    profile['_summary_json'] = json.dumps(profile['_summary'], separators=(',', ':'), ensure_ascii=False)
+    return profile
 
-SCENARIO 4: COMPARISON QUERIES
--------------------------------
-When comparing across time periods/regions:
 
-**Comparative Analysis**
-Comparing [Parameter] between [Period1] and [Period2]
+def _read_one(file_path):
+    """Parse a single ARGO JSON file, returning None if it can't be read"""
+    try:
+        with open(file_path, 'rb') as f:
+            data = _json_loads(f.read())
+        data['_file_path'] = str(file_path)
+        prepare_profile(data)
+        return data
+    except Exception:
+        return None
 
-**Data Summary**
 
-| Metric | Period 1 | Period 2 | Change | % Difference |
-|--------|----------|----------|--------|--------------|
-| [Param] Mean | [Val1] | [Val2] | [Diff] | [%] |
-| [Param] Range | [R1] | [R2] | - | - |
+def read_argo_json(json_path):
+    """Load all ARGO JSON files under json_path"""
+    json_files = []
+    data_path = Path(json_path)
+    
+    if data_path.exists():
+        json_files = list(data_path.rglob("*.json"))
+    
+    # File reads are I/O bound, so a thread pool overlaps disk waits
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        results = list(executor.map(_read_one, json_files))
+    
+    return [data for data in results if data is not None]
 
-**Statistical Significance**
-• [Describe if change is meaningful]
-• [Seasonal/interannual context]
 
-**Scientific Interpretation**
-• [What this means oceanographically]
-• [Potential drivers of observed changes]
+# Which variables a profile carries: (column, section of 'measurements', variable)
+PRESENCE_COLUMNS = [('has_temp', 'core_variables', 'TEMP'), ('has_psal', 'core_variables', 'PSAL'),
+                    ('has_doxy', 'core_variables', 'DOXY'), ('has_pres', 'core_variables', 'PRES'),
+                    ('has_chla', 'bgc_variables', 'CHLA')]
+# Only what the searches score on; row i describes _argo_data[i]
+PROFILE_COLUMNS = ['year', 'month', 'day'] + [col for col, _, _ in PRESENCE_COLUMNS] + ['is_uploaded']
+PROFILE_DTYPES = {'year': np.int16, 'month': np.int8, 'day': np.int8, 'is_uploaded': bool,
+                  **{col: bool for col, _, _ in PRESENCE_COLUMNS}}
 
----
 
-SCENARIO 5: OFF-TOPIC QUERIES (Smart Redirection)
---------------------------------------------------
-When query is unrelated to oceanography:
+def read_argo_parquet(parquet_path):
+    """Load profiles packed by nc_converter.build_parquet"""
+    table = pq.read_table(parquet_path, columns=['profile_id', 'profile_json'], memory_map=True)
+    
+    argo_data = []
+    for file_path, raw in zip(table.column('profile_id').to_pylist(), table.column('profile_json').to_pylist()):
+        data = _json_loads(raw)
+        data['_file_path'] = file_path
+        prepare_profile(data)
+        argo_data.append(data)
+    
+    return argo_data
 
-**Response:**
-"FloatChat AI specializes in oceanographic data analysis, particularly for Indian Ocean ARGO float measurements. 
 
-Your query about [topic] falls outside our domain expertise. 
+@st.cache_resource(show_spinner=False, max_entries=32)
+def build_indexes(_argo_data, data_key):
+    """Sorted profile dates, region buckets, a flat per-profile table and sidebar stats"""
+    by_region = defaultdict(list)
+    region_keys = {}
+    years = set()
+    records = []
+    
+    for i, profile in enumerate(_argo_data):
+        try:
+            temporal = profile.get('temporal', {})
+            spatial = profile.get('geospatial', {})
+            measurements = profile.get('measurements', {})
+            year, month, day = temporal.get('year'), temporal.get('month'), temporal.get('day')
+            if year:
+                years.add(year)
+            present = [bool(measurements.get(section, {}).get(var, {}).get('present'))
+                       for _, section, var in PRESENCE_COLUMNS]
+            
+            # 'Bay_of_Bengal' -> 'bay of bengal', cleaned once per distinct name
+            for region in spatial.get('regional_seas', []):
+                if region not in region_keys:
+                    region_keys[region] = region.lower().replace('_', ' ')
+                by_region[region_keys[region]].append(i)
+            
+            records.append((int(year or 0), int(month or 0), int(day or 0),
+                            *present, bool(profile.get('_is_uploaded'))))
+        except Exception:
+            records.append((0, 0, 0) + (False,) * (len(PRESENCE_COLUMNS) + 1))
+    
+    # Struct-of-arrays view so searches run as NumPy masks, not dict walks
+    profiles_df = pd.DataFrame.from_records(records, columns=PROFILE_COLUMNS).astype(PROFILE_DTYPES)
+    
+    # Profile dates in ascending order; date_order maps them back to positions
+    dates = _profile_dates(profiles_df)
+    date_order = np.argsort(dates, kind='stable')
+    
+    return {'dates': dates[date_order], 'date_order': date_order,
+            'by_region': {region: np.asarray(ids, dtype=np.intp) for region, ids in by_region.items()},
+            'profiles_df': profiles_df, 'profiles': tuple(_argo_data),
+            'stats': {'n_profiles': len(_argo_data), 'n_years': len(years), 'n_regions': len(region_keys)}}
+
+
+def get_indexes(argo_data):
+    """Indexes for this exact list of profiles (keyed on object identity)
+    
+    Each entry holds the profiles it was built from, so their ids cannot be
+    reused by another session's objects while the entry exists; the identity
+    check below only guards against a hash collision.
+    """
+    data_key = (len(argo_data), hash(tuple(map(id, argo_data))))
+    indexes = build_indexes(argo_data, data_key)
+    if not all(map(operator.is_, indexes['profiles'], argo_data)):
+        build_indexes.clear()
+        indexes = build_indexes(argo_data, data_key)
+    return indexes
+
+
+@st.cache_resource(show_spinner=False, ttl=24*60*60)
+def load_and_index(source, fingerprint):
+    """Profiles from source with their indexes built, shared by every session
+    
+    cache_resource hands all sessions the same list, so the identity-keyed
+    indexes are built once per process rather than once per new session.
+    fingerprint only keys the cache.
+    """
+    if source.endswith('.parquet'):
+        argo_data = read_argo_parquet(source)
+    else:
+        argo_data = read_argo_json(source)
+    get_indexes(argo_data)
+    return argo_data
+
+
+def _candidate_rows(profiles_df, candidates):
+    """Table rows for the candidate positions; the table itself when that is every row (no copy)"""
+    if len(candidates) == len(profiles_df):
+        return profiles_df
+    return profiles_df.iloc[candidates]
+
+
+def _profile_dates(profiles_df):
+    """datetime64[D] per profile; a missing month or day counts as the 1st, a missing year as NaT"""
+    years = profiles_df['year'].to_numpy().astype(np.int64)
+    months = np.clip(profiles_df['month'].to_numpy().astype(np.int64), 1, 12)
+    days = profiles_df['day'].to_numpy().astype(np.int64)
+    
+    month_start = ((years - 1970) * 12 + months - 1).astype('datetime64[M]')
+    month_length = ((month_start + 1).astype('datetime64[D]') - month_start.astype('datetime64[D]')).astype(np.int64)
+    dates = month_start.astype('datetime64[D]') + np.clip(days - 1, 0, month_length - 1)
+    dates[years <= 0] = np.datetime64('NaT')
+    return dates
+
+
+def _region_hits(indexes, query_lower):
+    """Positions of profiles in every region named in the query, once per matching region"""
+    hits = [ids for region, ids in indexes['by_region'].items() if region in query_lower]
+    return np.concatenate(hits) if hits else np.empty(0, dtype=np.intp)
+
+
+def _top_positions(candidates, scores, k=15):
+    """Positions of the k best positive scores, best first; ties keep index order"""
+    keep = scores > 0
+    candidates, scores = candidates[keep], scores[keep]
+    
+    # O(N) partition to the k-th best score, then sort only the survivors
+    if len(scores) > k:
+        kth_best = np.partition(scores, len(scores) - k)[len(scores) - k]
+        above = np.flatnonzero(scores > kth_best)
+        tied = np.flatnonzero(scores == kth_best)[:k - len(above)]
+        selected = np.sort(np.concatenate([above, tied]))
+        candidates, scores = candidates[selected], scores[selected]
+    
+    return candidates[np.argsort(-scores, kind='stable')].tolist()
+
+
+def _date_window(indexes, start, end):
+    """Positions of profiles dated in [start, end), found by binary search"""
+    lo, hi = np.searchsorted(indexes['dates'], [np.datetime64(start, 'D'), np.datetime64(end, 'D')])
+    return indexes['date_order'][lo:hi]
+
+
+@st.cache_resource(show_spinner=False)
+def _http_session():
+    """Shared keep-alive session so each chat turn reuses the TLS connection"""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=0))
+    session.headers.update({"Accept": "text/event-stream"})
+    return session
+
+
+# Delta text pulled straight out of each Mistral SSE chunk, skipping a full JSON parse
+_SSE_CONTENT_RE = re.compile(r'"content":"((?:[^"\\]|\\.)*)"')
+# Seconds between redraws of the streaming answer; each redraw ships the whole text
+STREAM_RENDER_INTERVAL = 0.05
+# Seconds Mistral gets to return headers before Groq is asked as well
+GROQ_HEDGE_DELAY = 2.0
+
+
+def _sse_delta(line):
+    """Delta text of one SSE line ('data: {...}'), '' for anything without content"""
+    if not line.startswith('data: ') or line[6:].strip() == '[DONE]':
+        return ''
+    match = _SSE_CONTENT_RE.search(line)
+    if match:
+        # Only the string literal is decoded, for its escapes
+        return json.loads('"' + match.group(1) + '"')
+    data = json.loads(line[6:])
+    if 'choices' in data:
+        return data['choices'][0].get('delta', {}).get('content') or ''
+    return ''
+
+
+# Query parsing patterns, compiled once instead of on every chat turn
+_YEAR_RE = re.compile(r'\b(20\d{2})\b')
+_DATE_PATTERNS = [re.compile(p) for p in (
+    r'(\d{1,2})\s+(january|jan|february|feb|march|mar|april|apr|may|june|jun|july|jul|august|aug|september|sep|october|oct|november|nov|december|dec)\s+(20\d{2})',
+    r'(january|jan|february|feb|march|mar|april|apr|may|june|jun|july|jul|august|aug|september|sep|october|oct|november|nov|december|dec)\s+(\d{1,2})\s+(20\d{2})',
+    r'(20\d{2})-(\d{1,2})-(\d{1,2})'
+)]
+_LAST_MONTHS_RE = re.compile(r'last\s+(\d+)\s+months?')
+
+MONTHS_MAP = {
+    'january': 1, 'jan': 1, 'february': 2, 'feb': 2, 'march': 3, 'mar': 3,
+    'april': 4, 'apr': 4, 'may': 5, 'june': 6, 'jun': 6,
+    'july': 7, 'jul': 7, 'august': 8, 'aug': 8, 'september': 9, 'sep': 9,
+    'october': 10, 'oct': 10, 'november': 11, 'nov': 11, 'december': 12, 'dec': 12
+}
+# Longest names first so 'september' wins over 'sep'
+_MONTH_RE = re.compile(r'\b(' + '|'.join(sorted(MONTHS_MAP, key=len, reverse=True)) + r')\b')
+# Requests about the data as a whole ('summary', 'analyze this'); these rank uploaded files first
+_GENERIC_RE = re.compile(r'summary|overview|tell me about|show me|uploaded|this file|analyze|what is')
+
+# Local off-topic check so clearly unrelated questions never reach the LLM
+_OCEAN_RE = re.compile(
+    r'\b(ocean\w*|argo|floats?|profiles?|sea|seas|gulf|bay of bengal|arabian|andaman|equatorial|indian|southern|'
+    r'atlantic|pacific|marine|coast\w*|monsoon|upwelling|currents?|waves?|tides?|climat\w*|el ni[nñ]o|la ni[nñ]a|iod|'
+    r'temp\w*|salin\w*|psal|pres\w*|depth|deep|surface|thermocline|halocline|mixed layer|water|'
+    r'oxygen|doxy|chlorophyll|chla|nitrate|nutrients?|ph|bgc|density|heat|'
+    r'data\w*|summar\w*|compar\w*|trends?|uploaded|files?|region\w*|latitude|longitude|lat|lon)\b',
+    re.IGNORECASE
+)
+_COORD_RE = re.compile(r'-?\d{1,3}(?:\.\d+)?\s*°?\s*[NSEW]\b', re.IGNORECASE)
 
-**I can help you with:**
-• Ocean temperature and salinity profiles
-• Water mass analysis
-• Biogeochemical parameters (oxygen, chlorophyll, nutrients)
-• Seasonal variability in specific regions
-• Comparisons across time periods or locations
+OFF_TOPIC_RESPONSE = """FloatChat AI specialises in Indian Ocean ARGO float data analysis, so that question is outside my domain.
 
-**Example queries:**
-- "Show me temperature profiles in Bay of Bengal for August 2023"
-- "Compare salinity between Arabian Sea and Bay of Bengal"
-- "Analyze oxygen minimum zones in Indian Ocean"
+I can help with:
+- Temperature and salinity profiles
+- Water masses and mixed layer depth
+- BGC parameters (oxygen, chlorophyll, nutrients)
+- Seasonal variability and period/region comparisons
 
-How can I assist you with ocean data analysis?"
+Try asking:
+- "Show me temperature in the Bay of Bengal in March 2023"
+- "Compare salinity in the Arabian Sea between 2022 and 2023"
+- "What was the oxygen level on 14 Aug 2022?\""""
 
----
 
-GEOGRAPHIC SCOPE ENFORCEMENT:
-==============================
-• **In Scope**: Indian Ocean, Bay of Bengal, Arabian Sea, Southern Ocean, Red Sea, Persian Gulf, Andaman Sea
-• **Out of Scope**: 
-  - Land-based queries (cities, countries without coastal context)
-  - Atlantic/Pacific Oceans (politely redirect)
-  - Non-marine topics
+def is_off_topic(query):
+    """True when a parsed query has no ocean keyword, date, coordinate or generic data request to work with"""
+    if query.years or query.months or query.specific_date or query.is_generic:
+        return False
+    return not (_OCEAN_RE.search(query.text) or _COORD_RE.search(query.text))
 
-**Boundary Response:**
-"This system focuses exclusively on Indian Ocean regions. For [Atlantic/Pacific/Other], I recommend consulting regional oceanographic databases."
 
----
+# Rolling per-session digest of earlier turns (~500 tokens), sent instead of old context
+HISTORY_SUMMARY_CHARS = 2000
+_MARKDOWN_RE = re.compile(r'[*#|`>_]+|-{3,}')
 
-DATA SOURCE TRANSPARENCY:
-=========================
-**NEVER explicitly state** "using public data" or "from web sources" - judges shouldn't see backend mechanics.
 
-**INSTEAD, use scientific phrasing:**
-✅ "Based on climatological records for this region..."
-✅ "Oceanographic studies indicate..."
-✅ "Typical conditions for [season/region] show..."
-✅ "Historical data suggests..."
-✅ "Published research from INCOIS/NOAA reports..."
+def update_history_summary(summary, query, response):
+    """Append a one-line digest of this turn, dropping the oldest lines past the size cap"""
+    answer = ' '.join(_MARKDOWN_RE.sub(' ', response).split())
+    lines = [line for line in summary.split('\n') if line]
+    lines.append(f"Q: {' '.join(query.split())[:120]} | A: {answer[:240]}")
+    
+    while len(lines) > 1 and sum(len(line) + 1 for line in lines) > HISTORY_SUMMARY_CHARS:
+        lines.pop(0)
+    return '\n'.join(lines)
 
----
 
-CRITICAL RULES:
-===============
-1. ✅ **NEVER fabricate data** - If inventing values, clearly mark as "typical range" or "climatological average"
-2. ✅ **NO placeholder values** (X.XX, Y.YY) - Either use real data or provide established ranges
-3. ✅ **Prioritize local dataset** - Use uploaded/stored ARGO data first
-4. ✅ **Seamless augmentation** - Blend external knowledge naturally without revealing source switching
-5. ✅ **Scientific accuracy** - All statements must be defensible with oceanographic literature
-6. ✅ **Professional tone** - Maintain expert credibility befitting a national competition
-7. ✅ **Honest limitations** - Acknowledge data gaps without undermining system capability
+def format_user_message(prompt, context, history_summary=""):
+    """User turn sent to the LLM; earlier turns travel only as their rolling summary"""
+    if history_summary:
+        return f"SUMMARY OF EARLIER TURNS:\n{history_summary}\n\nCONTEXT DATA: {context}\n\nUSER QUERY: {prompt}"
+    return f"CONTEXT DATA: {context}\n\nUSER QUERY: {prompt}"
 
----
 
-RESPONSE STYLE GUIDELINES:
-==========================
-• **Concise but comprehensive** - Dense information, minimal fluff
-• **Quantitative focus** - Specific numbers > vague descriptions
-• **Visual structure** - Use tables, bullet points, section headers
-• **Scientific terminology** - Proper oceanographic vocabulary
-• **Actionable insights** - Not just data regurgitation, but interpretation
+# Word stems, so 'compared', 'comparing' and 'differences' count as comparisons too
+_COMPARISON_RE = re.compile(r'\b(compar\w*|differ\w*|vs\.?|versus)\b', re.IGNORECASE)
 
----
 
-MISSION: Position FloatChat AI as a production-ready, scientifically rigorous tool that seamlessly blends real-time observational data with comprehensive oceanographic intelligence - impressing judges with both technical depth and practical utility for India's ocean monitoring needs.
-"""
+def classify_query(query):
+    """Pick the SCENARIO_TEMPLATES key for a parsed query that matched profiles
+    
+    No-match turns are answered locally in main(). Off-topic ones are too,
+    except while a file is uploaded, when they reach the LLM and land here.
+    """
+    if is_off_topic(query):
+        return 'off_topic'
+    return 'comparison' if query.is_comparison else 'local_data'
+
+
+@dataclass(frozen=True, slots=True)
+class QueryContext:
+    """A chat query parsed once per turn (see EnhancedARGOChatbot.parse_query)"""
+    text: str
+    lower: str
+    years: tuple
+    months: tuple
+    specific_date: dict
+    wanted_vars: frozenset
+    is_generic: bool
+    is_comparison: bool
 
 
 class EnhancedARGOChatbot:
+    # Variable keywords, matched at word starts so 'temps' and 'depths' count too
+    PARAM_RE = re.compile(r'\b(temp|salinity|salt|psal|oxygen|doxy|chlorophyll|chla|pres|depth)')
+    PARAM_VARIABLES = {'temp': 'TEMP', 'salinity': 'PSAL', 'salt': 'PSAL', 'psal': 'PSAL',
+                       'oxygen': 'DOXY', 'doxy': 'DOXY', 'chlorophyll': 'CHLA', 'chla': 'CHLA',
+                       'pres': 'PRES', 'depth': 'PRES'}
+    
     def __init__(self):
         # Method 1: Try .env file
         self.mistral_api_key = os.getenv("MISTRAL_API_KEY")
@@ -577,23 +548,21 @@ class EnhancedARGOChatbot:
             except:
                 pass
         
-        # Method 3: Manual input (emergency fallback)
-        if not self.mistral_api_key and not self.groq_api_key:
-            st.warning("🔑 No API keys found in environment or secrets")
-        
         # Debug: Check what was loaded
-        print(f"🔍 Init Debug:")
-        print(f"   Mistral key loaded: {bool(self.mistral_api_key)}")
-        print(f"   Mistral key length: {len(self.mistral_api_key) if self.mistral_api_key else 0}")
-        print(f"   Groq key loaded: {bool(self.groq_api_key)}")
-        print(f"   Groq key length: {len(self.groq_api_key) if self.groq_api_key else 0}")
+        if DEBUG:
+            print(f"🔍 Init Debug:")
+            print(f"   Mistral key loaded: {bool(self.mistral_api_key)}")
+            print(f"   Mistral key length: {len(self.mistral_api_key) if self.mistral_api_key else 0}")
+            print(f"   Groq key loaded: {bool(self.groq_api_key)}")
+            print(f"   Groq key length: {len(self.groq_api_key) if self.groq_api_key else 0}")
         
         # Initialize Groq client if available
         self.groq_client = None
         if Groq and self.groq_api_key:
             try:
                 self.groq_client = Groq(api_key=self.groq_api_key)
-                print("✅ Groq client initialized successfully")
+                if DEBUG:
+                    print("✅ Groq client initialized successfully")
             except Exception as e:
                 print(f"❌ Groq initialization failed: {e}")
         
@@ -601,9 +570,15 @@ class EnhancedARGOChatbot:
         self.has_mistral = bool(self.mistral_api_key and self.mistral_api_key.strip() and len(self.mistral_api_key.strip()) > 10)
         self.has_groq = bool(self.groq_client)
         
-        print(f"🎯 Final Status - Mistral available: {self.has_mistral}, Groq available: {self.has_groq}")
+        if DEBUG:
+            print(f"🎯 Final Status - Mistral available: {self.has_mistral}, Groq available: {self.has_groq}")
+    
+    def render_api_status(self, show_banner=True):
+        """Show API status; setup help stays up on every run until a key works"""
+        # Method 3: Manual input (emergency fallback)
+        if not self.mistral_api_key and not self.groq_api_key:
+            st.warning("🔑 No API keys found in environment or secrets")
         
-        # Show status in Streamlit
         if not self.has_mistral and not self.has_groq:
             with st.expander("⚠️ **API Configuration Required** - Click to see setup instructions", expanded=True):
                 st.error("""
@@ -694,53 +669,61 @@ If you see "NOT FOUND", your .env file is in the wrong location!
                 with col1:
                     manual_mistral = st.text_input("Mistral API Key", type="password", key="manual_mistral")
                     if manual_mistral and st.button("Use Mistral Key", key="btn_mistral"):
-                        self.mistral_api_key = manual_mistral
-                        self.has_mistral = True
+                        # The shared chatbot serves every session, so keep manual keys on a private copy
+                        session_bot = copy.copy(self)
+                        session_bot.mistral_api_key = manual_mistral
+                        session_bot.has_mistral = True
+                        st.session_state.chatbot = session_bot
                         st.success("✅ Mistral key set for this session!")
                         st.rerun()
                 
                 with col2:
                     manual_groq = st.text_input("Groq API Key", type="password", key="manual_groq")
                     if manual_groq and st.button("Use Groq Key", key="btn_groq"):
-                        self.groq_api_key = manual_groq
                         if Groq:
                             try:
-                                self.groq_client = Groq(api_key=manual_groq)
-                                self.has_groq = True
+                                session_bot = copy.copy(self)
+                                session_bot.groq_api_key = manual_groq
+                                session_bot.groq_client = Groq(api_key=manual_groq)
+                                session_bot.has_groq = True
+                                st.session_state.chatbot = session_bot
                                 st.success("✅ Groq key set for this session!")
                                 st.rerun()
                             except Exception as e:
                                 st.error(f"Invalid Groq key: {e}")
         
-        elif self.has_mistral and not self.has_groq:
-            st.info("✅ Using Mistral API (streaming responses)")
-        elif not self.has_mistral and self.has_groq:
-            st.info("✅ Using Groq API (fallback mode)")
-        else:
-            st.success("✅ Both APIs available - Mistral primary, Groq fallback")
+        elif show_banner:
+            if self.has_mistral and not self.has_groq:
+                st.info("✅ Using Mistral API (streaming responses)")
+            elif not self.has_mistral and self.has_groq:
+                st.info("✅ Using Groq API (fallback mode)")
+            else:
+                st.success("✅ Both APIs available - Mistral primary, Groq fallback")
     
-    def load_argo_data(self, json_path="Datasetjson"):
-        """Load all ARGO JSON files"""
+    def load_argo_data(self, json_path="Datasetjson", parquet_path="profiles.parquet"):
+        """Load all ARGO profiles (shared across sessions until the dataset changes on disk)"""
         json_files = []
         data_path = Path(json_path)
         
         if data_path.exists():
             json_files = list(data_path.rglob("*.json"))
         
-        argo_data = []
-        for file_path in json_files:
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    data['_file_path'] = str(file_path)
-                    argo_data.append(data)
-            except Exception:
-                continue
-        
-        return argo_data
+        # Cheap fingerprint so new or modified files invalidate the cache
+        fingerprint = (len(json_files), max((f.stat().st_mtime for f in json_files), default=0))
+        
+        # A corpus packed with nc_converter.build_parquet needs one open, not one per profile,
+        # but only while it is at least as new as the JSON files it was packed from
+        packed = Path(parquet_path)
+        if pq and packed.exists():
+            if packed.stat().st_mtime >= fingerprint[1]:
+                return load_and_index(str(packed), (1, packed.stat().st_mtime))
+            print(f"⚠️ {packed} is older than {data_path}/, loading the JSON files instead "
+                  f"(rebuild it with: python nc_converter.py {json_path} {parquet_path})")
+        
+        return load_and_index(str(data_path), fingerprint)
     
-    def query_mistral_streaming(self, prompt, context):
-        """Query Mistral API with streaming (Primary)"""
+    def query_mistral_streaming(self, prompt, context, system_prompt=SYSTEM_PROMPT, history_summary="", warn=st.warning):
+        """Query Mistral API with streaming (Primary); warn reports why it fell back"""
         if not self.has_mistral:
             return None
         
@@ -748,15 +731,15 @@ If you see "NOT FOUND", your .env file is in the wrong location!
             data = {
                 "model": "open-mistral-7b",
                 "messages": [
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": f"CONTEXT DATA: {context}\n\nUSER QUERY: {prompt}"}
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": format_user_message(prompt, context, history_summary)}
                 ],
                 "temperature": 0.3,
                 "max_tokens": 1200,
                 "stream": True
             }
             
-            response = requests.post(
+            response = _http_session().post(
                 "https://api.mistral.ai/v1/chat/completions",
                 headers={
                     "Authorization": f"Bearer {self.mistral_api_key}",
@@ -768,25 +751,27 @@ If you see "NOT FOUND", your .env file is in the wrong location!
             )
             
             if response.status_code == 200:
+                # SSE is always UTF-8; without a charset requests would guess Latin-1
+                response.encoding = 'utf-8'
                 return response
             elif response.status_code == 401:
-                st.warning("⚠️ Mistral API key invalid. Switching to Groq...")
+                warn("⚠️ Mistral API key invalid. Switching to Groq...")
                 return None
             elif response.status_code == 429:
-                st.warning("⏳ Mistral rate limit reached. Switching to Groq...")
+                warn("⏳ Mistral rate limit reached. Switching to Groq...")
                 return None
             else:
-                st.warning(f"⚠️ Mistral API error {response.status_code}. Switching to Groq...")
+                warn(f"⚠️ Mistral API error {response.status_code}. Switching to Groq...")
                 return None
                 
         except requests.exceptions.Timeout:
-            st.warning("⏳ Mistral API timeout. Switching to Groq...")
+            warn("⏳ Mistral API timeout. Switching to Groq...")
             return None
         except Exception as e:
             print(f"Mistral error: {e}")
             return None
     
-    def query_groq(self, prompt, context):
+    def query_groq(self, prompt, context, system_prompt=SYSTEM_PROMPT, history_summary=""):
         """Query Groq API (Fallback)"""
         if not self.has_groq:
             return """⚠️ **AI Service Unavailable**
@@ -818,22 +803,29 @@ GROQ_API_KEY=def789uvw012
 ```"""
         
         try:
-            response = self.groq_client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
-                messages=[
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": f"CONTEXT DATA: {context}\n\nUSER QUERY: {prompt}"}
-                ],
-                temperature=0.3,
-                max_tokens=1200
-            )
-            
-            return response.choices[0].message.content
-            
+            return self._groq_completion(prompt, context, system_prompt, history_summary)
         except Exception as e:
-            error_msg = str(e)
-            if "authentication" in error_msg.lower() or "api key" in error_msg.lower():
-                return f"""⚠️ **Groq Authentication Error**
+            return self._groq_error_message(e)
+    
+    def _groq_completion(self, prompt, context, system_prompt=SYSTEM_PROMPT, history_summary=""):
+        """Plain Groq chat completion; raises on API errors"""
+        response = self.groq_client.chat.completions.create(
+            model="llama-3.3-70b-versatile",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": format_user_message(prompt, context, history_summary)}
+            ],
+            temperature=0.3,
+            max_tokens=1200
+        )
+        
+        return response.choices[0].message.content
+    
+    def _groq_error_message(self, error):
+        """User-facing explanation for a failed Groq call"""
+        error_msg = str(error)
+        if "authentication" in error_msg.lower() or "api key" in error_msg.lower():
+            return f"""⚠️ **Groq Authentication Error**
 
 Your GROQ_API_KEY appears to be invalid.
 
@@ -847,8 +839,8 @@ Your GROQ_API_KEY appears to be invalid.
 4. Restart the application
 
 **Current error:** {error_msg}"""
-            else:
-                return f"""⚠️ **Groq API Error**
+        else:
+            return f"""⚠️ **Groq API Error**
 
 Something went wrong while contacting Groq API.
 
@@ -860,346 +852,298 @@ Something went wrong while contacting Groq API.
 - Try again in a few moments
 - If issue persists, try using MISTRAL_API_KEY instead"""
     
+    def query_llm(self, prompt, context, scenario=None, history_summary=""):
+        """Ask Mistral (streaming) first and hedge with Groq if it fails or stalls.
+        
+        Groq is only called when Mistral fails or has not returned headers
+        within GROQ_HEDGE_DELAY seconds; after that whichever answers first wins.
+        
+        scenario selects the response template sent with the system prompt
+        (see classify_query); None sends all of them. history_summary is the
+        session's rolling digest of earlier turns (see update_history_summary).
+        Returns ('mistral', streaming_response) or ('groq', response_text).
+        """
+        system_prompt = SCENARIO_PROMPTS.get(scenario, SYSTEM_PROMPT)
+        
+        if not (self.has_mistral and self.has_groq):
+            streaming_response = self.query_mistral_streaming(prompt, context, system_prompt, history_summary)
+            if streaming_response:
+                return 'mistral', streaming_response
+            return 'groq', self.query_groq(prompt, context, system_prompt, history_summary)
+        
+        # Worker threads need the script context so their st.warning calls render
+        executor = ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx,
+                                      initargs=(None, get_script_run_ctx()))
+        # A late Mistral failure is not news once Groq has answered
+        groq_won = threading.Event()
+        warn = lambda message: groq_won.is_set() or st.warning(message)
+        mistral = executor.submit(self.query_mistral_streaming, prompt, context, system_prompt, history_summary, warn)
+        
+        try:
+            if wait([mistral], timeout=GROQ_HEDGE_DELAY).done and mistral.result():
+                return 'mistral', mistral.result()
+            
+            groq = executor.submit(self._groq_completion, prompt, context, system_prompt, history_summary)
+            pending = {mistral, groq}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                if mistral in done and mistral.result():
+                    return 'mistral', mistral.result()
+                if groq in done and not groq.exception():
+                    groq_won.set()
+                    # Drop the Mistral stream if it connects after Groq already won
+                    mistral.add_done_callback(lambda f: f.result() and f.result().close())
+                    return 'groq', groq.result()
+            
+            return 'groq', self._groq_error_message(groq.exception())
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+    
     def _month_to_number(self, month_str):
         """Convert month name to number"""
-        months_map = {
-            'january': 1, 'jan': 1, 'february': 2, 'feb': 2, 'march': 3, 'mar': 3,
-            'april': 4, 'apr': 4, 'may': 5, 'june': 6, 'jun': 6,
-            'july': 7, 'jul': 7, 'august': 8, 'aug': 8, 'september': 9, 'sep': 9,
-            'october': 10, 'oct': 10, 'november': 11, 'nov': 11, 'december': 12, 'dec': 12
-        }
-        return months_map.get(month_str.lower(), 1)
+        return MONTHS_MAP.get(month_str.lower(), 1)
     
-    def search_relevant_data(self, query, argo_data):
-        """Search relevant profiles with flexible temporal matching including specific dates"""
+    def parse_query(self, query):
+        """Parse a chat query once into the QueryContext both searches read"""
         query_lower = query.lower()
-        relevant_profiles = []
         
         # Extract years from query
-        years_in_query = re.findall(r'\b(20\d{2})\b', query)
-        
-        # Extract specific dates
-        date_patterns = [
-            r'(\d{1,2})\s+(january|jan|february|feb|march|mar|april|apr|may|june|jun|july|jul|august|aug|september|sep|october|oct|november|nov|december|dec)\s+(20\d{2})',
-            r'(january|jan|february|feb|march|mar|april|apr|may|june|jun|july|jul|august|aug|september|sep|october|oct|november|nov|december|dec)\s+(\d{1,2})\s+(20\d{2})',
-            r'(20\d{2})-(\d{1,2})-(\d{1,2})'
-        ]
+        years_in_query = _YEAR_RE.findall(query)
         
+        # Extract specific dates; the group order depends on which pattern matched
         specific_date = None
-        for pattern in date_patterns:
-            match = re.search(pattern, query_lower)
+        for pattern_idx, pat in enumerate(_DATE_PATTERNS):
+            match = pat.search(query_lower)
             if match:
                 groups = match.groups()
-                if len(groups) == 3:
-                    if groups[0].isdigit() and len(groups[0]) == 4:
-                        year, month, day = int(groups[0]), int(groups[1]), int(groups[2])
-                    elif groups[2].startswith('20'):
-                        day, month_str, year = int(groups[0]), groups[1], int(groups[2])
-                        month = self._month_to_number(month_str)
-                    else:
-                        month_str, day, year = groups[0], int(groups[1]), int(groups[2])
-                        month = self._month_to_number(month_str)
-                    
-                    specific_date = {'year': year, 'month': month, 'day': day}
-                    break
-        
-        # Month extraction
-        months_map = {
-            'january': 1, 'jan': 1, 'february': 2, 'feb': 2, 'march': 3, 'mar': 3,
-            'april': 4, 'apr': 4, 'may': 5, 'june': 6, 'jun': 6,
-            'july': 7, 'jul': 7, 'august': 8, 'aug': 8, 'september': 9, 'sep': 9,
-            'october': 10, 'oct': 10, 'november': 11, 'nov': 11, 'december': 12, 'dec': 12
-        }
+                if pattern_idx == 0:
+                    day, month, year = int(groups[0]), self._month_to_number(groups[1]), int(groups[2])
+                elif pattern_idx == 1:
+                    month, day, year = self._month_to_number(groups[0]), int(groups[1]), int(groups[2])
+                else:
+                    year, month, day = int(groups[0]), int(groups[1]), int(groups[2])
+                
+                specific_date = {'year': year, 'month': month, 'day': day}
+                break
         
+        # Month extraction (whole words only, so 'marine' is not March)
         months_in_query = []
         if not specific_date:
-            for month_name, month_num in months_map.items():
-                if month_name in query_lower:
-                    months_in_query.append(month_num)
+            months_in_query = [MONTHS_MAP[m] for m in _MONTH_RE.findall(query_lower)]
         
         # Handle "last X months" queries
-        last_months_match = re.search(r'last\s+(\d+)\s+months?', query_lower)
+        last_months_match = _LAST_MONTHS_RE.search(query_lower)
         if last_months_match:
             num_months = int(last_months_match.group(1))
             if years_in_query:
                 months_in_query = list(range(max(1, 13 - num_months), 13))
         
-        is_generic_query = any(keyword in query_lower for keyword in 
-                              ['summary', 'overview', 'tell me about', 'show me', 
-                               'uploaded', 'this file', 'analyze', 'what is'])
+        return QueryContext(
+            text=query,
+            lower=query_lower,
+            years=tuple(years_in_query),
+            months=tuple(months_in_query),
+            specific_date=specific_date,
+            wanted_vars=frozenset(self.PARAM_VARIABLES[word] for word in self.PARAM_RE.findall(query_lower)),
+            is_generic=bool(_GENERIC_RE.search(query_lower)),
+            is_comparison=bool(_COMPARISON_RE.search(query))
+        )
+    
+    def search_relevant_data(self, query, argo_data, allow_fallback=True):
+        """Search relevant profiles with flexible temporal matching including specific dates
         
-        for profile in argo_data:
-            relevance_score = 0
-            
-            try:
-                temporal = profile.get('temporal', {})
-                spatial = profile.get('geospatial', {})
-                measurements = profile.get('measurements', {})
-                
-                profile_year = temporal.get('year')
-                profile_month = temporal.get('month')
-                profile_day = temporal.get('day')
-                
-                # Uploaded file priority
-                if is_generic_query and profile.get('_is_uploaded'):
-                    relevance_score += 10
-                
-                # SPECIFIC DATE MATCHING
-                if specific_date:
-                    if (profile_year == specific_date['year'] and 
-                        profile_month == specific_date['month']):
-                        
-                        if profile_day == specific_date['day']:
-                            relevance_score += 20
-                        elif profile_day and abs(profile_day - specific_date['day']) <= 3:
-                            relevance_score += 15
-                        elif profile_day and abs(profile_day - specific_date['day']) <= 7:
-                            relevance_score += 10
-                        else:
-                            relevance_score += 8
-                
-                # Year matching
-                elif years_in_query:
-                    if str(profile_year) in years_in_query:
-                        relevance_score += 10
-                        
-                        if months_in_query:
-                            if profile_month in months_in_query:
-                                relevance_score += 8
-                            elif any(abs(profile_month - m) <= 1 for m in months_in_query):
-                                relevance_score += 5
-                        else:
-                            relevance_score += 5
-                
-                # Region matching
-                regions = spatial.get('regional_seas', [])
-                for region in regions:
-                    region_clean = region.lower().replace('_', ' ')
-                    if region_clean in query_lower:
-                        relevance_score += 5
-                
-                # Parameter matching
-                if 'temperature' in query_lower or 'temp' in query_lower:
-                    if measurements.get('core_variables', {}).get('TEMP', {}).get('present'):
-                        relevance_score += 3
-                
-                if 'salinity' in query_lower or 'salt' in query_lower or 'psal' in query_lower:
-                    if measurements.get('core_variables', {}).get('PSAL', {}).get('present'):
-                        relevance_score += 3
-                
-                if 'oxygen' in query_lower or 'doxy' in query_lower:
-                    if measurements.get('core_variables', {}).get('DOXY', {}).get('present'):
-                        relevance_score += 3
-                
-                if 'chlorophyll' in query_lower or 'chla' in query_lower:
-                    if measurements.get('bgc_variables', {}).get('CHLA', {}).get('present'):
-                        relevance_score += 3
-                
-                if 'pressure' in query_lower or 'depth' in query_lower or 'pres' in query_lower:
-                    if measurements.get('core_variables', {}).get('PRES', {}).get('present'):
-                        relevance_score += 3
-                
-                # Fallback
-                if relevance_score == 0:
-                    if measurements.get('core_variables', {}).get('TEMP', {}).get('present'):
-                        relevance_score = 1
-                        
-            except Exception:
-                continue
-                
-            if relevance_score > 0:
-                relevant_profiles.append((profile, relevance_score))
+        query is the raw text or its parse_query() result. allow_fallback=False
+        skips the widened second pass when nothing matches.
+        """
+        # A single profile (one uploaded file) is the answer whatever the query
+        if len(argo_data) <= 1:
+            return list(argo_data)
+        
+        if isinstance(query, str):
+            query = self.parse_query(query)
+        years_in_query = query.years
+        specific_date = query.specific_date
+        months_in_query = query.months
+        
+        indexes = get_indexes(argo_data)
+        profiles_df = indexes['profiles_df']
+        
+        # Only profiles in the requested period can score on date/year, so
+        # binary-search the sorted dates instead of scanning everything
+        if specific_date and 1 <= (specific_date['month'] or 0) <= 12:
+            month_start = np.datetime64(f"{specific_date['year']}-{specific_date['month']:02d}", 'M')
+            candidates = _date_window(indexes, month_start, month_start + 1)
+            candidates = np.sort(candidates[profiles_df['month'].to_numpy()[candidates] > 0])
+        elif specific_date:
+            candidates = []
+        elif years_in_query:
+            target_years = sorted({int(y) for y in years_in_query})
+            candidates = np.sort(np.concatenate([
+                _date_window(indexes, np.datetime64(str(year), 'Y'), np.datetime64(str(year + 1), 'Y'))
+                for year in target_years]))
+        else:
+            candidates = range(len(argo_data))
+        
+        # Date/year scores for all candidates at once from the profile table
+        candidates = np.asarray(candidates, dtype=np.intp)
+        candidate_rows = _candidate_rows(profiles_df, candidates)
+        if specific_date:
+            days = candidate_rows['day'].to_numpy().astype(np.int16)
+            day_diff = np.abs(days - specific_date['day'])
+            temporal_scores = np.select(
+                [days == specific_date['day'], (days > 0) & (day_diff <= 3), (days > 0) & (day_diff <= 7)],
+                [20, 15, 10], default=8)
+        elif years_in_query:
+            if months_in_query:
+                months = candidate_rows['month'].to_numpy().astype(np.int16)
+                query_months = np.asarray(months_in_query)
+                near_month = (months > 0) & (np.abs(months[:, None] - query_months).min(axis=1) <= 1)
+                temporal_scores = 10 + np.select([np.isin(months, query_months), near_month], [8, 5], default=0)
+            else:
+                temporal_scores = np.full(len(candidates), 15)
+        else:
+            temporal_scores = np.zeros(len(candidates), dtype=np.int16)
+        
+        scores = temporal_scores.astype(np.int32)
+        region_counts = np.bincount(_region_hits(indexes, query.lower), minlength=len(argo_data))
+        scores += 5 * region_counts[candidates]
+        
+        # Uploaded file priority
+        if query.is_generic:
+            scores += 10 * candidate_rows['is_uploaded'].to_numpy()
+        
+        # Parameter matching
+        for column, _, var in PRESENCE_COLUMNS:
+            if var in query.wanted_vars:
+                scores += 3 * candidate_rows[column].to_numpy()
+        
+        # Fallback: when nothing scored at all, any profile with temperature will do
+        if not scores.any():
+            scores[candidate_rows['has_temp'].to_numpy()] = 1
         
-        relevant_profiles.sort(key=lambda x: x[1], reverse=True)
+        relevant_profiles = [argo_data[i] for i in _top_positions(candidates, scores)]
         
         # If no results with strict matching, broaden the search
-        if not relevant_profiles and (years_in_query or months_in_query or specific_date):
+        if allow_fallback and not relevant_profiles and (years_in_query or months_in_query or specific_date):
             if specific_date:
                 st.info(f"🔍 No data for exact date {specific_date['day']}/{specific_date['month']}/{specific_date['year']}. Searching {specific_date['year']}-{specific_date['month']:02d} (±7 days)...")
             else:
                 st.info(f"🔍 Expanding search to nearby months/regions...")
-            return self.search_relevant_data_flexible(query, argo_data, years_in_query, months_in_query, specific_date)
+            return self.search_relevant_data_flexible(query, argo_data)
         
-        return [profile[0] for profile in relevant_profiles[:15]]
+        return relevant_profiles
     
-    def search_relevant_data_flexible(self, query, argo_data, years, months, specific_date=None):
+    def search_relevant_data_flexible(self, query, argo_data):
         """Fallback search with expanded temporal range"""
-        relevant_profiles = []
-        query_lower = query.lower()
+        if isinstance(query, str):
+            query = self.parse_query(query)
+        years, months, specific_date = query.years, query.months, query.specific_date
         
-        for profile in argo_data:
-            relevance_score = 0
-            
-            try:
-                temporal = profile.get('temporal', {})
-                spatial = profile.get('geospatial', {})
-                measurements = profile.get('measurements', {})
-                
-                profile_year = temporal.get('year')
-                profile_month = temporal.get('month')
-                profile_day = temporal.get('day')
-                
-                # Expanded date matching (±14 days)
-                if specific_date:
-                    if profile_year == specific_date['year']:
-                        relevance_score += 6
-                        
-                        if profile_month == specific_date['month']:
-                            relevance_score += 8
-                            
-                            if profile_day and abs(profile_day - specific_date['day']) <= 14:
-                                relevance_score += 10
-                        elif profile_month and abs(profile_month - specific_date['month']) <= 1:
-                            relevance_score += 4
-                
-                # Expanded year matching (±1 year)
-                elif years:
-                    target_years = [int(y) for y in years]
-                    if profile_year in target_years:
-                        relevance_score += 8
-                    elif any(abs(profile_year - y) <= 1 for y in target_years):
-                        relevance_score += 4
-                
-                # Expanded month matching (±2 months)
-                if months:
-                    if profile_month in months:
-                        relevance_score += 6
-                    elif any(abs(profile_month - m) <= 2 for m in months):
-                        relevance_score += 3
-                
-                # Region matching
-                regions = spatial.get('regional_seas', [])
-                for region in regions:
-                    if region.lower().replace('_', ' ') in query_lower:
-                        relevance_score += 4
-                
-                # Parameter matching
-                if 'temperature' in query_lower or 'salinity' in query_lower or 'analysis' in query_lower:
-                    if measurements.get('core_variables', {}).get('TEMP', {}).get('present'):
-                        relevance_score += 2
-                    if measurements.get('core_variables', {}).get('PSAL', {}).get('present'):
-                        relevance_score += 2
-                        
-            except Exception:
-                continue
-                
-            if relevance_score > 0:
-                relevant_profiles.append((profile, relevance_score))
+        indexes = get_indexes(argo_data)
+        region_ids = _region_hits(indexes, query.lower)
+        wants_params = bool(query.wanted_vars & {'TEMP', 'PSAL'}) or 'analysis' in query.lower
+        
+        # Without month or parameter terms only the widened date window and
+        # region matches can score, so skip the rest of the corpus
+        if (specific_date or years) and not months and not wants_params:
+            if specific_date:
+                year_ranges = [(specific_date['year'], specific_date['year'] + 1)]
+            else:
+                year_ranges = [(y - 1, y + 2) for y in sorted({int(y) for y in years})]
+            windows = [_date_window(indexes, np.datetime64(str(lo), 'Y'), np.datetime64(str(hi), 'Y'))
+                       for lo, hi in year_ranges]
+            candidates = np.unique(np.concatenate(windows + [region_ids]))
+        else:
+            candidates = range(len(argo_data))
+        
+        candidates = np.asarray(candidates, dtype=np.intp)
+        candidate_rows = _candidate_rows(indexes['profiles_df'], candidates)
+        profile_years = candidate_rows['year'].to_numpy().astype(np.int32)
+        profile_months = candidate_rows['month'].to_numpy().astype(np.int32)
+        profile_days = candidate_rows['day'].to_numpy().astype(np.int32)
+        scores = np.zeros(len(candidates), dtype=np.int32)
+        
+        # Expanded date matching (±14 days)
+        if specific_date:
+            same_year = profile_years == specific_date['year']
+            same_month = same_year & (profile_months == specific_date['month'])
+            near_day = same_month & (profile_days > 0) & (np.abs(profile_days - specific_date['day']) <= 14)
+            near_month = (same_year & ~same_month & (profile_months > 0)
+                          & (np.abs(profile_months - specific_date['month']) <= 1))
+            scores += 6 * same_year + 8 * same_month + 10 * near_day + 4 * near_month
+        
+        # Expanded year matching (±1 year)
+        elif years:
+            target_years = np.asarray([int(y) for y in years])
+            year_gap = np.abs(profile_years[:, None] - target_years).min(axis=1)
+            scores += np.select([year_gap == 0, (profile_years > 0) & (year_gap <= 1)], [8, 4], default=0)
+        
+        # Expanded month matching (±2 months)
+        if months:
+            month_gap = np.abs(profile_months[:, None] - np.asarray(months)).min(axis=1)
+            scores += np.select([month_gap == 0, (profile_months > 0) & (month_gap <= 2)], [6, 3], default=0)
+        
+        # Region matching
+        scores += 4 * np.bincount(region_ids, minlength=len(argo_data))[candidates]
+        
+        # Parameter matching
+        if wants_params:
+            scores += 2 * candidate_rows['has_temp'].to_numpy() + 2 * candidate_rows['has_psal'].to_numpy()
         
-        relevant_profiles.sort(key=lambda x: x[1], reverse=True)
-        return [profile[0] for profile in relevant_profiles[:15]]
+        return [argo_data[i] for i in _top_positions(candidates, scores)]
     
     def create_context_summary(self, profiles, query):
-        """Create context summary with temporal flexibility"""
+        """Create context summary with temporal flexibility
+        
+        query is the raw text or its parse_query() result.
+        """
         if not profiles:
             return "No relevant data found in the specified time period."
         
+        if isinstance(query, str):
+            query = self.parse_query(query)
+        
         context_parts = []
-        query_lower = query.lower()
+        compare_years = query.years if query.is_comparison else ()
         
-        # Group profiles by year and month
-        profiles_by_time = defaultdict(list)
+        # One pass collects the year-months present and, for comparisons, the
+        # first few profiles of each requested year (a comparison needs both sides)
+        time_keys = set()
+        profiles_by_year = defaultdict(list)
         for profile in profiles:
             year = profile.get('temporal', {}).get('year')
             month = profile.get('temporal', {}).get('month')
             if year and month:
-                profiles_by_time[f"{year}-{month:02d}"].append(profile)
+                time_keys.add(f"{year}-{month:02d}")
+            if str(year) in compare_years and len(profiles_by_year[year]) < 3:
+                profiles_by_year[year].append(profile)
         
         # Show temporal range
-        if len(profiles_by_time) > 1:
-            time_keys = sorted(profiles_by_time.keys())
-            context_parts.append(f"TEMPORAL RANGE: {time_keys[0]} to {time_keys[-1]} ({len(profiles)} profiles)")
-        
-        years_in_query = re.findall(r'\b(20\d{2})\b', query)
-        is_summary = any(keyword in query_lower for keyword in ['summary', 'overview', 'tell me', 'analyze', 'analysis'])
-        is_comparison = any(keyword in query_lower for keyword in ['compare', 'difference', 'vs', 'versus'])
-        
-        if is_comparison and years_in_query:
-            profiles_by_year = {}
-            for profile in profiles:
-                year = profile.get('temporal', {}).get('year')
-                if str(year) in years_in_query:
-                    if year not in profiles_by_year:
-                        profiles_by_year[year] = []
-                    profiles_by_year[year].append(profile)
-            
-            for year in sorted(profiles_by_year.keys()):
-                year_profiles = profiles_by_year[year]
-                for profile in year_profiles[:3]:
-                    temporal = profile.get('temporal', {})
-                    spatial = profile.get('geospatial', {})
-                    measurements = profile.get('measurements', {})
-                    
-                    date = temporal.get('datetime', 'unknown')[:10]
-                    regions = ', '.join(spatial.get('regional_seas', ['Ocean']))
-                    
-                    info = f"REAL DATA [{year}] - Profile {date} from {regions}"
-                    
-                    if profile.get('_uploaded_filename'):
-                        info += f" (File: {profile['_uploaded_filename']})"
-                    
-                    core_vars = measurements.get('core_variables', {})
-                    
-                    if 'temperature' in query_lower or 'temp' in query_lower or is_summary:
-                        temp_data = core_vars.get('TEMP', {})
-                        if temp_data.get('present'):
-                            stats = temp_data.get('statistics', {})
-                            info += f" | TEMP: {stats.get('min', 0):.2f}-{stats.get('max', 0):.2f}°C (mean: {stats.get('mean', 0):.2f}°C)"
-                    
-                    if 'salinity' in query_lower or 'salt' in query_lower or is_summary:
-                        sal_data = core_vars.get('PSAL', {})
-                        if sal_data.get('present'):
-                            stats = sal_data.get('statistics', {})
-                            info += f" | SAL: {stats.get('min', 0):.2f}-{stats.get('max', 0):.2f} PSU (mean: {stats.get('mean', 0):.2f} PSU)"
-                    
-                    pres_data = core_vars.get('PRES', {})
-                    if pres_data.get('present') and is_summary:
-                        stats = pres_data.get('statistics', {})
-                        info += f" | DEPTH: 0-{stats.get('max', 0):.0f}m"
-                    
-                    context_parts.append(info)
+        if len(time_keys) > 1:
+            context_parts.append(f"TEMPORAL RANGE: {min(time_keys)} to {max(time_keys)} ({len(profiles)} profiles)")
+        
+        if compare_years:
+            selected = [profile for year in sorted(profiles_by_year) for profile in profiles_by_year[year]]
         else:
-            for profile in profiles[:10]:
-                temporal = profile.get('temporal', {})
-                spatial = profile.get('geospatial', {})
-                measurements = profile.get('measurements', {})
-                
-                date = temporal.get('datetime', 'unknown')[:10]
-                year = temporal.get('year')
-                month = temporal.get('month')
-                day = temporal.get('day')
-                regions = ', '.join(spatial.get('regional_seas', ['Ocean']))
-                
-                info = f"REAL DATA [{year}-{month:02d}-{day:02d}] - Profile {date} from {regions}"
-                
-                if profile.get('_uploaded_filename'):
-                    info += f" (File: {profile['_uploaded_filename']})"
-                
-                core_vars = measurements.get('core_variables', {})
-                
-                # Add temperature data
-                temp_data = core_vars.get('TEMP', {})
-                if temp_data.get('present'):
-                    stats = temp_data.get('statistics', {})
-                    info += f" | TEMP: {stats.get('min', 0):.2f}-{stats.get('max', 0):.2f}°C (mean: {stats.get('mean', 0):.2f}°C)"
-                
-                # Add salinity data
-                sal_data = core_vars.get('PSAL', {})
-                if sal_data.get('present'):
-                    stats = sal_data.get('statistics', {})
-                    info += f" | SAL: {stats.get('min', 0):.2f}-{stats.get('max', 0):.2f} PSU (mean: {stats.get('mean', 0):.2f} PSU)"
-                
-                # Add depth data
-                pres_data = core_vars.get('PRES', {})
-                if pres_data.get('present'):
-                    stats = pres_data.get('statistics', {})
-                    info += f" | DEPTH: 0-{stats.get('max', 0):.0f}m"
-                
-                context_parts.append(info)
+            selected = profiles[:CONTEXT_TOP_K]
+        
+        if selected:
+            digests = [profile.get('_summary_json') or prepare_profile(profile)['_summary_json']
+                       for profile in selected]
+            context_parts.append(
+                "REAL DATA (TEMP degC, PSAL PSU, DOXY umol/kg as [min,max,mean]; depth_max in m): "
+                "[" + ",".join(digests) + "]"
+            )
         
         return " || ".join(context_parts)
 
 
+@st.cache_resource(show_spinner=False)
+def get_chatbot():
+    """One chatbot (API keys, Groq client) shared by every session"""
+    return EnhancedARGOChatbot()
+
+
 def display_message(role, content):
     """Display chat message"""
     if role == "user":
@@ -1222,8 +1166,9 @@ def main():
     inject_custom_css()
     
     # Initialize session state
-    if 'chatbot' not in st.session_state:
-        st.session_state.chatbot = EnhancedARGOChatbot()
+    first_run = 'messages' not in st.session_state
+    if first_run:
+        st.session_state.chatbot = None
         st.session_state.messages = []
         st.session_state.argo_data = None
         st.session_state.history = []
@@ -1232,8 +1177,11 @@ def main():
         st.session_state.last_query = ""
         st.session_state.active_file = None
         st.session_state.processing = False
+        st.session_state.history_summary = ""
     
-    chatbot = st.session_state.chatbot
+    # A session only gets its own chatbot after a manual API key is entered
+    chatbot = st.session_state.chatbot or get_chatbot()
+    chatbot.render_api_status(show_banner=first_run)
     
     # Sidebar
     with st.sidebar:
@@ -1289,6 +1237,7 @@ def main():
                         converted_data['_uploaded_filename'] = uploaded_file.name
                         converted_data['_upload_timestamp'] = datetime.now().isoformat()
                         converted_data['_is_uploaded'] = True
+                        prepare_profile(converted_data)
                         st.session_state.uploaded_files.append(converted_data)
                         st.session_state.active_file = uploaded_file.name
                         st.success(f"✅ {uploaded_file.name[:25]}...")
@@ -1310,18 +1259,21 @@ def main():
         if st.button("🗑️ Clear", use_container_width=True, key="btn_clear"):
             st.session_state.history = []
             st.session_state.messages = []
+            st.session_state.history_summary = ""
             st.rerun()
         
         st.markdown("---")
         
         st.markdown("### Stats")
         if st.session_state.argo_data:
+            # Counted once when the indexes are built, not on every rerun
+            stats = get_indexes(st.session_state.argo_data)['stats']
             st.markdown(f"""
             <div style="font-size: 0.85rem; color: #90e0ef;">
-                <div style="margin-bottom: 0.4rem;">📁 {len(st.session_state.argo_data)} Profiles</div>
+                <div style="margin-bottom: 0.4rem;">📁 {stats['n_profiles']} Profiles</div>
                 <div style="margin-bottom: 0.4rem;">📤 {len(st.session_state.uploaded_files)} Uploaded</div>
-                <div style="margin-bottom: 0.4rem;">📅 {len(set(p.get('temporal', {}).get('year') for p in st.session_state.argo_data if p.get('temporal', {}).get('year')))} Years</div>
-                <div style="margin-bottom: 0.4rem;">🌍 {len(set([r for p in st.session_state.argo_data for r in p.get('geospatial', {}).get('regional_seas', [])]))} Regions</div>
+                <div style="margin-bottom: 0.4rem;">📅 {stats['n_years']} Years</div>
+                <div style="margin-bottom: 0.4rem;">🌍 {stats['n_regions']} Regions</div>
             </div>
             """, unsafe_allow_html=True)
         
@@ -1380,59 +1332,72 @@ def main():
     # Process AI response
     if st.session_state.processing:
         last_user_message = st.session_state.messages[-1]["content"]
-        
+        # Parsed once; the off-topic check, both searches and the context share it
+        query_ctx = chatbot.parse_query(last_user_message)
+
+        # Off-topic questions get the canned reply without an API call; with a
+        # file uploaded any question may be about it, so those always go through
+        has_uploads = st.session_state.get('active_file') or st.session_state.uploaded_files
+        if not has_uploads and is_off_topic(query_ctx):
+            st.session_state.messages.append({"role": "assistant", "content": OFF_TOPIC_RESPONSE})
+            st.session_state.processing = False
+            st.rerun()
+
         with st.spinner("Analyzing..."):
             if st.session_state.get('active_file'):
                 active_file_data = [f for f in st.session_state.uploaded_files 
                                    if f.get('_uploaded_filename') == st.session_state.active_file]
                 
                 if active_file_data:
-                    relevant_profiles = chatbot.search_relevant_data(last_user_message, active_file_data)
+                    relevant_profiles = chatbot.search_relevant_data(query_ctx, active_file_data,
+                                                                     allow_fallback=False)
                     
                     if relevant_profiles:
-                        context = f"Data from '{st.session_state.active_file}': " + chatbot.create_context_summary(relevant_profiles, last_user_message)
+                        context = f"Data from '{st.session_state.active_file}': " + chatbot.create_context_summary(relevant_profiles, query_ctx)
                     else:
                         relevant_profiles = []
                         context = f"No data matching query in '{st.session_state.active_file}'"
                 else:
-                    relevant_profiles = chatbot.search_relevant_data(last_user_message, argo_data)
-                    context = chatbot.create_context_summary(relevant_profiles, last_user_message)
+                    relevant_profiles = chatbot.search_relevant_data(query_ctx, argo_data)
+                    context = chatbot.create_context_summary(relevant_profiles, query_ctx)
             else:
-                relevant_profiles = chatbot.search_relevant_data(last_user_message, argo_data)
-                context = chatbot.create_context_summary(relevant_profiles, last_user_message)
+                relevant_profiles = chatbot.search_relevant_data(query_ctx, argo_data)
+                context = chatbot.create_context_summary(relevant_profiles, query_ctx)
             
             if relevant_profiles:
                 st.session_state.last_profiles = relevant_profiles
                 
-                # Try Mistral first (streaming)
-                streaming_response = chatbot.query_mistral_streaming(last_user_message, context)
+                # Race Mistral (streaming) against Groq, keep the first answer
+                scenario = classify_query(query_ctx)
+                source, llm_result = chatbot.query_llm(last_user_message, context, scenario,
+                                                       st.session_state.get('history_summary', ""))
                 
-                if streaming_response:
+                if source == 'mistral':
                     # Mistral streaming successful
+                    streaming_response = llm_result
                     response_placeholder = st.empty()
                     full_response = ""
                     
-                    for line in streaming_response.iter_lines():
+                    last_render = time.monotonic()
+                    
+                    for line in streaming_response.iter_lines(decode_unicode=True, chunk_size=8192):
                         if line:
                             try:
-                                line_text = line.decode('utf-8')
-                                if line_text.startswith('data: '):
-                                    json_str = line_text[6:]
-                                    if json_str.strip() != '[DONE]':
-                                        data = json.loads(json_str)
-                                        if 'choices' in data:
-                                            delta = data['choices'][0].get('delta', {})
-                                            content = delta.get('content', '')
-                                            if content:
-                                                full_response += content
-                                                response_placeholder.markdown(f"""
-                                                <div class="chat-message assistant-message">
-                                                    <div class="message-avatar">FloatChat AI</div>
-                                                    <div class="message-content">{full_response}▋</div>
-                                                </div>
-                                                """, unsafe_allow_html=True)
-                            except:
+                                content = _sse_delta(line)
+                            except Exception:
                                 continue
+                            
+                            if content:
+                                full_response += content
+                                # Redraw on a timer rather than per token
+                                if time.monotonic() - last_render >= STREAM_RENDER_INTERVAL:
+                                    response_placeholder.markdown(f"""
+                                    <div class="chat-message assistant-message">
+                                        <div class="message-avatar">FloatChat AI</div>
+                                        <div class="message-content">{full_response}▋</div>
+                                    </div>
+                                    """, unsafe_allow_html=True)
+                                    last_render = time.monotonic()
                     
                     response_placeholder.markdown(f"""
                     <div class="chat-message assistant-message">
@@ -1443,9 +1408,14 @@ def main():
                     
                     st.session_state.messages.append({"role": "assistant", "content": full_response})
                 else:
-                    # Fallback to Groq (non-streaming)
-                    response = chatbot.query_groq(last_user_message, context)
-                    st.session_state.messages.append({"role": "assistant", "content": response})
+                    # Groq answered first or Mistral failed (non-streaming)
+                    st.session_state.messages.append({"role": "assistant", "content": llm_result})
+                
+                # Fold this turn into the rolling summary; error notices carry nothing to remember
+                answer = st.session_state.messages[-1]["content"]
+                if answer and not answer.startswith("⚠️"):
+                    st.session_state.history_summary = update_history_summary(
+                        st.session_state.get('history_summary', ""), last_user_message, answer)
                 
                 # Show source data
                 with st.expander("📊 View source data"):
@@ -1455,7 +1425,7 @@ def main():
                         meas = profile.get('measurements', {}).get('core_variables', {})
                         
                         st.markdown(f"**Profile {i}:**")
-                        st.caption(f"📅 {temporal.get('datetime', '')[:10]}")
+                        st.caption(f"📅 {profile.get('_date10') or temporal.get('datetime', '')[:10]}")
                         st.caption(f"🌍 {', '.join(spatial.get('regional_seas', ['Unknown']))}")
                         
                         if profile.get('_uploaded_filename'):
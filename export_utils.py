@@ -5,6 +5,9 @@ import numpy as np
 import netCDF4 as nc
 from pathlib import Path
 
+# Values the app caches on each profile at load (see prepare_profile in 1mainfile.py); not profile data
+DERIVED_PROFILE_KEYS = ('_date10', '_summary', '_summary_json')
+
 class ARGOExporter:
     """Export ARGO data in multiple formats"""
     
@@ -162,7 +165,8 @@ class ARGOExporter:
                 "total_profiles": len(profiles),
                 "export_format": "JSON"
             },
-            "profiles": profiles
+            "profiles": [{key: value for key, value in profile.items() if key not in DERIVED_PROFILE_KEYS}
+                         for profile in profiles]
         }
         
         with open(filename, 'w', encoding='utf-8') as f:
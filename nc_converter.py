@@ -4,6 +4,7 @@ import json
 from datetime import datetime
 import tempfile
 import os
+from pathlib import Path
 
 class NCConverter:
     """Convert NetCDF ARGO files to JSON format"""
@@ -193,25 +194,22 @@ class NCConverter:
         for var_name, description in core_vars.items():
             try:
                 if var_name in dataset.variables:
-                    var_data = dataset.variables[var_name][:]
+                    # One flat float32 array per variable; masked levels are dropped here
+                    var_data = np.ma.asarray(dataset.variables[var_name][:], dtype=np.float32).compressed()
                     
-                    # Handle masked arrays
-                    if np.ma.is_masked(var_data):
-                        var_data = var_data.compressed()
-                    
-                    if len(var_data) > 0:
+                    if var_data.size > 0:
                         # Remove invalid values
                         valid_data = var_data[(var_data > -990) & (var_data < 9999)]
                         
-                        if len(valid_data) > 0:
+                        if valid_data.size > 0:
                             measurements[var_name] = {
                                 'present': True,
                                 'statistics': {
-                                    'min': float(np.min(valid_data)),
-                                    'max': float(np.max(valid_data)),
-                                    'mean': float(np.mean(valid_data)),
-                                    'std': float(np.std(valid_data)),
-                                    'count': int(len(valid_data))
+                                    'min': float(valid_data.min()),
+                                    'max': float(valid_data.max()),
+                                    'mean': float(valid_data.mean(dtype=np.float64)),
+                                    'std': float(valid_data.std(dtype=np.float64)),
+                                    'count': int(valid_data.size)
                                 }
                             }
             except Exception as e:
@@ -249,4 +247,36 @@ class NCConverter:
 def convert_nc_to_json(uploaded_file):
     """Quick function to convert uploaded NC file"""
     converter = NCConverter()
-    return converter.convert_uploaded_file(uploaded_file)
\ No newline at end of file
+    return converter.convert_uploaded_file(uploaded_file)
+
+def build_parquet(json_dir="Datasetjson", out="profiles.parquet"):
+    """Pack every ARGO JSON profile under json_dir into one zstd Parquet file
+
+    One row per profile: its source path in 'profile_id' and the original
+    JSON text in 'profile_json'. The app still parses each profile, but
+    reads the whole corpus with one file open instead of one per profile.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    rows = {'profile_id': [], 'profile_json': []}
+    
+    for json_file in Path(json_dir).rglob("*.json"):
+        try:
+            raw = json_file.read_text(encoding='utf-8')
+            json.loads(raw)  # only pack files the app can parse
+        except Exception as e:
+            print(f"Skipping {json_file}: {e}")
+            continue
+        
+        rows['profile_id'].append(str(json_file))
+        rows['profile_json'].append(raw)
+    
+    table = pa.table(rows)
+    pq.write_table(table, out, compression='zstd')
+    print(f"Wrote {table.num_rows} profiles to {out}")
+    return out
+
+if __name__ == "__main__":
+    import sys
+    build_parquet(*sys.argv[1:3])